@@ -1,13 +1,20 @@
 import os
+import asyncio
 import asyncpg
 import logging
 import pyotp
 
-from fastapi import FastAPI, HTTPException
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import date
+from enum import Enum
 from typing import Optional
 
 
@@ -21,7 +28,120 @@ DB_DSN = os.getenv("DATABASE_URL")
 if not DB_DSN:
     raise RuntimeError("DATABASE_URL не задан в .env")
 
-app = FastAPI()
+# max_size — это сколько запросов к БД реально может идти одновременно,
+# а не число HTTP-воркеров: каждый воркер uvicorn держит свой пул.
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", 10))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", 50))
+
+# Кэш баланса на 0.5 с гасит шквал опросов /api/balance.
+# Кэш живёт в процессе, поэтому при нескольких воркерах возможны
+# устаревшие чтения — включается явно через BALANCE_CACHE=1.
+BALANCE_CACHE = os.getenv("BALANCE_CACHE") == "1"
+_bal_cache: TTLCache = TTLCache(maxsize=10000, ttl=0.5)
+
+db_pool: asyncpg.Pool | None = None
+
+
+# SQL горячих эндпоинтов. asyncpg кэширует prepared statement на каждом
+# соединении по тексту запроса (statement_cache_size), так что Postgres
+# разбирает и планирует каждый из них один раз на соединение.
+_SQL_BALANCE = "SELECT balance_usdt FROM users WHERE tg_id = $1"
+
+_SQL_DEPOSIT = """
+    SELECT da.address
+    FROM deposit_addresses da
+    JOIN users u ON da.user_id = u.id
+    WHERE u.tg_id = $1
+    ORDER BY da.assigned_at DESC
+    LIMIT 1
+    """
+
+# Вся логика изменения баланса (UPDATE + запись в operations) —
+# в функции change_balance, см. migrations/004_change_balance_no_clamp.sql.
+_SQL_CHANGE = "SELECT change_balance($1, $2)"
+
+_SQL_USER_EXISTS = "SELECT 1 FROM users WHERE tg_id = $1"
+
+_SQL_PD_SAVE = """
+    UPDATE users
+    SET
+        first_name = $1,
+        last_name  = $2,
+        birth_date = $3,
+        gender     = $4
+    WHERE tg_id = $5
+    RETURNING first_name, last_name, birth_date, gender
+    """
+
+_SQL_PD_GET = """
+    SELECT first_name, last_name, birth_date, gender
+    FROM users
+    WHERE tg_id = $1
+    """
+
+_SQL_PROFILE_BUNDLE = """
+    SELECT u.balance_usdt,
+           u.first_name,
+           u.last_name,
+           u.birth_date,
+           u.gender,
+           (
+               SELECT da.address
+               FROM deposit_addresses da
+               WHERE da.user_id = u.id
+               ORDER BY da.assigned_at DESC
+               LIMIT 1
+           ) AS address
+    FROM users u
+    WHERE u.tg_id = $1
+    """
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    # NUMERIC (balance_usdt, amount) сразу в float: без промежуточного Decimal,
+    # ответы всё равно отдают float.
+    await conn.set_type_codec(
+        "numeric",
+        encoder=str,
+        decoder=float,
+        schema="pg_catalog",
+        format="text",
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global db_pool
+    logger.info("Connecting to Postgres from API...")
+    # create_pool сразу открывает min_size соединений (и прогоняет init),
+    # так что первые запросы не платят за подключение к БД.
+    db_pool = await asyncpg.create_pool(
+        DB_DSN,
+        min_size=PG_POOL_MIN,
+        max_size=PG_POOL_MAX,
+        statement_cache_size=1024,
+        max_inactive_connection_lifetime=300,
+        # command_timeout — предел на стороне клиента, statement_timeout — на стороне
+        # сервера. Через server_settings, а не SET в init: пул делает RESET ALL
+        # при возврате соединения, а параметры старта сессии его переживают.
+        command_timeout=2.0,
+        server_settings={
+            "statement_timeout": "1500ms",
+            "idle_in_transaction_session_timeout": "5s",
+        },
+        init=_init_connection,
+    )
+    logger.info("API DB pool created (min_size=%s, max_size=%s)", PG_POOL_MIN, PG_POOL_MAX)
+
+    yield
+
+    await db_pool.close()
+    logger.info("API DB pool closed")
+
+
+# Класс ответа по умолчанию не меняем: с response_model FastAPI сериализует
+# сразу в JSON-байты через Pydantic, date/datetime — в ISO-8601.
+app = FastAPI(lifespan=lifespan)
 
 # Разрешаем запросы с твоего фронта
 origins = [
@@ -37,23 +157,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-db_pool: asyncpg.Pool | None = None
+_CORS_ORIGINS = frozenset(o.encode() for o in origins)
+_PREFLIGHT_HEADERS = [
+    (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+    (b"access-control-allow-credentials", b"true"),
+    (b"access-control-max-age", b"600"),
+    (b"vary", b"Origin, Access-Control-Request-Method, Access-Control-Request-Headers"),
+]
 
 
-@app.on_event("startup")
-async def on_startup():
-    global db_pool
-    logger.info("Connecting to Postgres from API...")
-    db_pool = await asyncpg.create_pool(DB_DSN)
-    logger.info("API DB pool created")
+class PreflightMiddleware:
+    """
+    Отвечает на CORS preflight (OPTIONS) для /api/* прямо на уровне ASGI,
+    не собирая Request и не проходя стек FastAPI.
+    Всё остальное (и preflight с чужих origin) уходит дальше в CORSMiddleware.
+    Если перед API стоит nginx, эти OPTIONS можно отдавать прямо там.
+    """
 
+    def __init__(self, app):
+        self.app = app
 
-@app.on_event("shutdown")
-async def on_shutdown():
-    global db_pool
-    if db_pool:
-        await db_pool.close()
-        logger.info("API DB pool closed")
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] == "http"
+            and scope["method"] == "OPTIONS"
+            and scope["path"].startswith("/api/")
+        ):
+            origin = req_headers = None
+            has_method = False
+            for key, value in scope["headers"]:
+                if key == b"origin":
+                    origin = value
+                elif key == b"access-control-request-method":
+                    has_method = True
+                elif key == b"access-control-request-headers":
+                    req_headers = value
+
+            if has_method and origin in _CORS_ORIGINS:
+                headers = [(b"access-control-allow-origin", origin), *_PREFLIGHT_HEADERS]
+                if req_headers is not None:
+                    headers.append((b"access-control-allow-headers", req_headers))
+                await send({"type": "http.response.start", "status": 204, "headers": headers})
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+        await self.app(scope, receive, send)
+
+
+# добавлен последним — значит, стоит снаружи CORSMiddleware
+app.add_middleware(PreflightMiddleware)
+
+
+@app.exception_handler(asyncio.TimeoutError)
+@app.exception_handler(asyncpg.QueryCanceledError)
+async def db_timeout_handler(request, exc):
+    # Зависший запрос не держит слот пула: отдаём 503, клиент может повторить.
+    logger.warning("DB timeout on %s: %r", request.url.path, exc)
+    return JSONResponse(status_code=503, content={"detail": "Database timeout"})
 
 
 class BalanceRequest(BaseModel):
@@ -63,103 +223,122 @@ class DepositAddressRequest(BaseModel):
     tg_id: int
 
 
-@app.post("/api/balance")
-async def get_balance(req: BalanceRequest):
+@app.get("/api/balance/{tg_id}")
+async def get_balance(tg_id: int, response: Response):
     """
     Возвращает баланс по Telegram ID.
     """
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT balance_usdt FROM users WHERE tg_id = $1",
-            req.tg_id,
-        )
+    bal = _bal_cache.get(tg_id) if BALANCE_CACHE else None
 
-    if not row:
-        raise HTTPException(status_code=404, detail="User not found")
+    if bal is None:
+        bal = await db_pool.fetchval(_SQL_BALANCE, tg_id)
+
+        if bal is None:
+            raise HTTPException(status_code=404, detail="User not found")
 
+        if BALANCE_CACHE:
+            # Пока шёл запрос к БД, change_balance мог положить в кэш более
+            # свежий баланс — его не перезаписываем.
+            bal = _bal_cache.setdefault(tg_id, bal)
+
+    # баланс меняется часто — браузеру разрешаем держать его секунду
+    response.headers["Cache-Control"] = "private, max-age=1"
     return {
-        "balance": float(row["balance_usdt"])
+        "balance": bal
     }
 
 
-class BalanceChangeRequest(BaseModel):
-    tg_id: int
-    delta: float   # на сколько изменить баланс (+выигрыш, -ставка)
+@app.post("/api/balance", deprecated=True)
+async def get_balance_post(req: BalanceRequest, response: Response):
+    """
+    Старый POST-вариант для фронта, который ещё не перешёл на GET.
+    """
+    return await get_balance(req.tg_id, response)
+
 
-@app.post("/api/deposit-address")
-async def get_deposit_address(req: DepositAddressRequest):
+@app.get("/api/deposit-address/{tg_id}")
+async def get_deposit_address(tg_id: int, response: Response):
     """
     Возвращает депозит-адрес пользователя по его Telegram ID.
     """
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            SELECT da.address
-            FROM deposit_addresses da
-            JOIN users u ON da.user_id = u.id
-            WHERE u.tg_id = $1
-            ORDER BY da.assigned_at DESC
-            LIMIT 1
-            """,
-            req.tg_id,
-        )
+    row = await db_pool.fetchrow(_SQL_DEPOSIT, tg_id)
 
     if not row:
         raise HTTPException(status_code=404, detail="Deposit address not found")
 
+    # адрес выдаётся редко, минуту его можно не перезапрашивать
+    response.headers["Cache-Control"] = "private, max-age=60"
     return {"address": row["address"]}
 
 
+@app.post("/api/deposit-address", deprecated=True)
+async def get_deposit_address_post(req: DepositAddressRequest, response: Response):
+    """
+    Старый POST-вариант для фронта, который ещё не перешёл на GET.
+    """
+    return await get_deposit_address(req.tg_id, response)
+
+
+@dataclass
+class BalanceChange:
+    # dataclass вместо BaseModel: тело JSON то же, но без экземпляра модели
+    tg_id: int
+    delta: float   # на сколько изменить баланс (+выигрыш, -ставка)
+
+
 @app.post("/api/change-balance")
-async def change_balance(req: BalanceChangeRequest):
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            # 1) найдём user_id
-            user_row = await conn.fetchrow(
-                "SELECT id FROM users WHERE tg_id = $1",
-                req.tg_id,
-            )
-            if not user_row:
-                raise HTTPException(status_code=404, detail="User not found")
-
-            user_id = user_row["id"]
-
-            # 2) обновим баланс
-            row = await conn.fetchrow(
-                """
-                UPDATE users
-                SET balance_usdt = GREATEST(0, balance_usdt + $1)
-                WHERE id = $2
-                RETURNING balance_usdt
-                """,
-                req.delta,
-                user_id,
-            )
+async def change_balance(req: BalanceChange):
+    """
+    Меняет баланс на delta и возвращает новый баланс —
+    отдельный запрос /api/balance после этого не нужен.
+    """
+    bal = await db_pool.fetchval(_SQL_CHANGE, req.tg_id, req.delta)
 
-            # 3) запишем операцию в историю
-            await conn.execute(
-                """
-                INSERT INTO operations (user_id, amount, currency, type, status)
-                VALUES ($1, $2, 'USDT', 'admin_change', 'done')
-                """,
-                user_id,
-                req.delta,
-            )
+    # NULL — либо нет пользователя, либо не хватает средств
+    if bal is None:
+        if await db_pool.fetchval(_SQL_USER_EXISTS, req.tg_id) is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        raise HTTPException(status_code=402, detail="Insufficient funds")
+
+    if BALANCE_CACHE:
+        _bal_cache[req.tg_id] = bal
 
-    return {"balance": float(row["balance_usdt"])}
+    return {"balance": bal}
 
 # --------- НОВОЕ: модель для персональных данных ----------
 
+class GenderEnum(str, Enum):
+    MALE = "male"
+    FEMALE = "female"
+    OTHER = "other"
+
+
+# в БД users.gender — SMALLINT; migrations/002_gender_smallint.sql
+# должна быть применена до выкладки этого кода
+_GENDER_TO_DB = {GenderEnum.OTHER: 0, GenderEnum.MALE: 1, GenderEnum.FEMALE: 2}
+_GENDER_FROM_DB = {v: k.value for k, v in _GENDER_TO_DB.items()}
+
+
 class PersonalDataRequest(BaseModel):
     tg_id: int
     first_name: Optional[str] = None
     last_name: Optional[str] = None
     birth_date: Optional[str] = None  # формат YYYY-MM-DD из <input type="date">
-    gender: Optional[str] = None      # 'male' / 'female' / и т.п.
+    gender: Optional[GenderEnum] = None
+
+
+class PersonalDataResponse(BaseModel):
+    # схема строится при импорте, а не на первом ответе
+    model_config = ConfigDict(extra="ignore", defer_build=False)
+
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    birth_date: Optional[date] = None
+    gender: Optional[str] = None
 
 
 # делаем эндпоинт с тем же путём, что и на фронте: /api/profile
-@app.post("/api/personal-data/save")
+@app.post("/api/personal-data/save", response_model=PersonalDataResponse)
 async def save_personal_data(req: PersonalDataRequest):
     """
     Сохраняет персональные данные пользователя в таблицу users по tg_id.
@@ -169,7 +348,12 @@ async def save_personal_data(req: PersonalDataRequest):
     birth_date_db = None
     if req.birth_date:
         try:
-            birth_date_db = datetime.strptime(req.birth_date, "%Y-%m-%d").date()
+            # fromisoformat с 3.11 принимает и "20000102", и "2000-W01-1" —
+            # пропускаем только YYYY-MM-DD
+            bd = req.birth_date
+            if len(bd) != 10 or bd[4] != "-" or bd[7] != "-":
+                raise ValueError(bd)
+            birth_date_db = date.fromisoformat(bd)
         except ValueError:
             raise HTTPException(
                 status_code=400,
@@ -177,67 +361,86 @@ async def save_personal_data(req: PersonalDataRequest):
             )
 
     # 2. Обновляем пользователя в БД
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            UPDATE users
-            SET
-                first_name = $1,
-                last_name  = $2,
-                birth_date = $3,
-                gender     = $4
-            WHERE tg_id = $5
-            RETURNING first_name, last_name, birth_date, gender
-            """,
-            req.first_name,
-            req.last_name,
-            birth_date_db,
-            req.gender,
-            req.tg_id,
-        )
+    row = await db_pool.fetchrow(
+        _SQL_PD_SAVE,
+        req.first_name,
+        req.last_name,
+        birth_date_db,
+        _GENDER_TO_DB.get(req.gender),
+        req.tg_id,
+    )
 
     if not row:
         raise HTTPException(status_code=404, detail="User not found")
 
-    return {
-        "first_name": row["first_name"],
-        "last_name": row["last_name"],
-        "birth_date": row["birth_date"].isoformat() if row["birth_date"] else None,
-        "gender": row["gender"],
-    }
+    return PersonalDataResponse(
+        first_name=row["first_name"],
+        last_name=row["last_name"],
+        birth_date=row["birth_date"],
+        gender=_GENDER_FROM_DB.get(row["gender"]),
+    )
 
 class PersonalDataGetRequest(BaseModel):
     tg_id: int
 
 
-@app.post("/api/personal-data/get")
-async def get_personal_data(req: PersonalDataGetRequest):
+@app.get("/api/personal-data/{tg_id}", response_model=PersonalDataResponse)
+async def get_personal_data(tg_id: int):
     """
     Возвращает персональные данные пользователя по tg_id.
     """
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            SELECT first_name, last_name, birth_date, gender
-            FROM users
-            WHERE tg_id = $1
-            """,
-            req.tg_id,
-        )
+    row = await db_pool.fetchrow(_SQL_PD_GET, tg_id)
 
     if not row:
         # Если юзер ещё не заполнял профиль — просто 404
         raise HTTPException(status_code=404, detail="User not found")
 
+    return PersonalDataResponse(
+        first_name=row["first_name"],
+        last_name=row["last_name"],
+        # birth_date в JSON будет "YYYY-MM-DD", что идеально для <input type="date">
+        birth_date=row["birth_date"],
+        gender=_GENDER_FROM_DB.get(row["gender"]),
+    )
+
+
+@app.post(
+    "/api/personal-data/get",
+    response_model=PersonalDataResponse,
+    deprecated=True,
+)
+async def get_personal_data_post(req: PersonalDataGetRequest):
+    """
+    Старый POST-вариант для фронта, который ещё не перешёл на GET.
+    """
+    return await get_personal_data(req.tg_id)
+
+
+class ProfileBundleRequest(BaseModel):
+    tg_id: int
+
+
+@app.post("/api/profile/bundle")
+async def get_profile_bundle(req: ProfileBundleRequest):
+    """
+    Возвращает баланс, персональные данные и депозит-адрес одним запросом
+    (вместо трёх вызовов /api/balance, /api/personal-data/get и /api/deposit-address).
+    """
+    row = await db_pool.fetchrow(_SQL_PROFILE_BUNDLE, req.tg_id)
+
+    if not row:
+        raise HTTPException(status_code=404, detail="User not found")
+
     return {
+        "balance": row["balance_usdt"],
         "first_name": row["first_name"],
         "last_name": row["last_name"],
-        # birth_date в JSON будет "YYYY-MM-DD", что идеально для <input type="date">
-        "birth_date": row["birth_date"].isoformat() if row["birth_date"] else None,
-        "gender": row["gender"],
+        "birth_date": row["birth_date"],
+        "gender": _GENDER_FROM_DB.get(row["gender"]),
+        # адреса может ещё не быть — тогда null
+        "address": row["address"],
     }
 
-import pyotp
 
 class TwoFAInitRequest(BaseModel):
     tg_id: int
@@ -260,18 +463,17 @@ async def twofa_init(req: TwoFAInitRequest):
     """
     secret = pyotp.random_base32()
 
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            UPDATE users
-            SET ga_secret = $1,
-                twofa_enabled = FALSE
-            WHERE tg_id = $2
-            RETURNING id
-            """,
-            secret,
-            req.tg_id,
-        )
+    row = await db_pool.fetchrow(
+        """
+        UPDATE users
+        SET ga_secret = $1,
+            twofa_enabled = FALSE
+        WHERE tg_id = $2
+        RETURNING id
+        """,
+        secret,
+        req.tg_id,
+    )
 
     if not row:
         raise HTTPException(status_code=404, detail="User not found")
@@ -318,11 +520,10 @@ async def twofa_status(req: TwoFAStatusRequest):
     """
     Возвращает, включена ли 2FA.
     """
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT twofa_enabled FROM users WHERE tg_id = $1",
-            req.tg_id,
-        )
+    row = await db_pool.fetchrow(
+        "SELECT twofa_enabled FROM users WHERE tg_id = $1",
+        req.tg_id,
+    )
 
     if not row:
         raise HTTPException(status_code=404, detail="User not found")
@@ -334,35 +535,34 @@ class DepositHistoryRequest(BaseModel):
 
 @app.post("/api/deposit-history")
 async def deposit_history(req: DepositHistoryRequest):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            """
-            SELECT o.amount,
-                   o.currency,
-                   o.type,
-                   o.status,
-                   o.network,
-                   o.txid,
-                   o.created_at
-            FROM operations o
-            JOIN users u ON o.user_id = u.id
-            WHERE u.tg_id = $1
-            ORDER BY o.created_at DESC
-            LIMIT 100
-            """,
-            req.tg_id,
-        )
+    rows = await db_pool.fetch(
+        """
+        SELECT o.amount,
+               o.currency,
+               o.type,
+               o.status,
+               o.network,
+               o.txid,
+               o.created_at
+        FROM operations o
+        JOIN users u ON o.user_id = u.id
+        WHERE u.tg_id = $1
+        ORDER BY o.created_at DESC
+        LIMIT 100
+        """,
+        req.tg_id,
+    )
 
     # фронт ждёт список объектов
     return [
         {
-            "amount": float(r["amount"]),
+            "amount": r["amount"],
             "currency": r["currency"],
             "type": r["type"],
             "status": r["status"],
             "network_name": r["network"],
             "txid": r["txid"],
-            "created_at": r["created_at"].isoformat(),
+            "created_at": r["created_at"],
             # флаги для определения "ручного" пополнения
             "is_manual": (r["type"] == "admin_change"),
             "from_admin": (r["type"] == "admin_change"),
@@ -371,12 +571,17 @@ async def deposit_history(req: DepositHistoryRequest):
     ]
 
 
+if __name__ == "__main__":
+    import uvicorn
 
-
-
-
-
-
-
-
-
+    # uvicorn[standard] ставит uvloop и httptools; задаём их явно, чтобы сервер
+    # не стартовал молча на чистом asyncio/h11, если их нет в окружении.
+    # То же из консоли: uvicorn api:app --loop uvloop --http httptools --workers N
+    # Число воркеров — WEB_CONCURRENCY (по умолчанию 1), у каждого свой пул БД.
+    uvicorn.run(
+        "api:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+    )
@@ -0,0 +1,16 @@
+-- Индексы под запросы api.py.
+-- Запускать вручную: psql "$DATABASE_URL" -f migrations/001_hot_path_indexes.sql
+-- CONCURRENTLY не блокирует запись в таблицы, но не работает внутри транзакции.
+
+-- Все горячие запросы ищут пользователя по tg_id.
+-- Только ключ, без INCLUDE: balance_usdt и поля профиля часто меняются,
+-- а изменение любой колонки индекса (и INCLUDE тоже) запрещает HOT-update —
+-- каждое изменение баланса писало бы новые записи в индекс и лишний WAL.
+-- Если на users.tg_id уже есть UNIQUE-ограничение, этот индекс его дублирует.
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_tg_id
+    ON users (tg_id);
+
+-- Последний выданный депозит-адрес пользователя:
+-- ORDER BY assigned_at DESC LIMIT 1 читается из индекса без сортировки.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_deposit_addresses_user_assigned
+    ON deposit_addresses (user_id, assigned_at DESC);
@@ -0,0 +1,16 @@
+-- users.gender: TEXT -> SMALLINT (0 = other, 1 = male, 2 = female).
+-- Соответствие задаётся _GENDER_TO_DB в api.py.
+-- ПРИМЕНИТЬ ДО выкладки api.py с GenderEnum: код пишет в gender число,
+-- и пока колонка TEXT, каждое /api/personal-data/save падает с 500.
+-- Перезаписывает таблицу под ACCESS EXCLUSIVE блокировкой — запускать в окно обслуживания.
+-- Необратимо: любые другие значения ('Male', 'ж', пустая строка и т.п.)
+-- превращаются в 0 ('other'), исходный текст не сохраняется.
+-- Проверить заранее: SELECT gender, count(*) FROM users GROUP BY gender;
+ALTER TABLE users
+    ALTER COLUMN gender TYPE SMALLINT
+    USING CASE
+        WHEN gender IS NULL THEN NULL
+        WHEN gender = 'male' THEN 1
+        WHEN gender = 'female' THEN 2
+        ELSE 0
+    END;
@@ -0,0 +1,26 @@
+-- Изменение баланса целиком на стороне сервера: обновление users
+-- и запись в operations за один вызов (SELECT change_balance($1, $2) в api.py).
+-- Возвращает новый баланс или NULL, если пользователя с таким tg_id нет.
+CREATE OR REPLACE FUNCTION change_balance(p_tg_id BIGINT, p_delta NUMERIC)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_user_id users.id%TYPE;
+    v_balance NUMERIC;
+BEGIN
+    UPDATE users
+    SET balance_usdt = GREATEST(0, balance_usdt + p_delta)
+    WHERE tg_id = p_tg_id
+    RETURNING id, balance_usdt INTO v_user_id, v_balance;
+
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO operations (user_id, amount, currency, type, status)
+    VALUES (v_user_id, p_delta, 'USDT', 'admin_change', 'done');
+
+    RETURN v_balance;
+END;
+$$;
@@ -0,0 +1,28 @@
+-- change_balance больше не обрезает баланс до нуля: если средств не хватает,
+-- UPDATE не находит строку и ничего не пишет (ни в users, ни в operations).
+-- Возвращает новый баланс или NULL — пользователя нет или средств недостаточно;
+-- api.py различает эти случаи отдельным запросом только на этом пути.
+CREATE OR REPLACE FUNCTION change_balance(p_tg_id BIGINT, p_delta NUMERIC)
+RETURNS NUMERIC
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_user_id users.id%TYPE;
+    v_balance NUMERIC;
+BEGIN
+    UPDATE users
+    SET balance_usdt = balance_usdt + p_delta
+    WHERE tg_id = p_tg_id
+      AND balance_usdt + p_delta >= 0
+    RETURNING id, balance_usdt INTO v_user_id, v_balance;
+
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO operations (user_id, amount, currency, type, status)
+    VALUES (v_user_id, p_delta, 'USDT', 'admin_change', 'done');
+
+    RETURN v_balance;
+END;
+$$;